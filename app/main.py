@@ -1,37 +1,46 @@
+import codecs
+import functools
+import mmap
+import re
 import struct
 import sys
 from collections import namedtuple
 
 import app.parser as parser
 
+# Casefolded names the schema table can be queried under
+_SYSTEM_TABLES = frozenset(
+    name.casefold()
+    for name in ("sqlite_schema", "sqlite_master", "sqlite_temp_schema", "sqlite_temp_master")
+)
+
 def main():
     # Get the database file path and command from the command line arguments
     database_file_path = sys.argv[1]
     command = sys.argv[2]
 
-    # Open the database file in binary read mode
+    # Open the database file in binary read mode and map it into memory so
+    # pages can be handed to the parsers without copying
     with open(database_file_path, "rb") as database_file:
-        # Skip the first 16 bytes of the header
-        database_file.seek(16)
-        # Read the next 2 bytes to get the page size
-        page_size = int.from_bytes(database_file.read(2), byteorder="big")
+        mm = mmap.mmap(database_file.fileno(), 0, access=mmap.ACCESS_READ)
+        # Read the 2 bytes at offset 16 to get the page size
+        page_size = int.from_bytes(mm[16:18], byteorder="big")
 
-        # Skip to the 56th byte to read the text encoding
-        database_file.seek(56)
+        # Read the 4 bytes at offset 56 to get the text encoding
         text_encoding = ["utf-8", "utf-16-le", "utf-16-be"][
-            int.from_bytes(database_file.read(4), byteorder="big") - 1
+            int.from_bytes(mm[56:60], byteorder="big") - 1
         ]
 
         # Create a DBConfig namedtuple to store the page size and text encoding
         db_config = DBConfig(page_size=page_size, text_encoding=text_encoding)
+        db = Database(mm, db_config)
 
         if command == ".dbinfo":
             # Print the database page size
             print(f"database page size: {page_size}")
 
             # Read the first page of the database
-            database_file.seek(0)
-            page = database_file.read(page_size)
+            page = db.get_page(1)
             # Parse the B-tree header from the first page
             btree_header = parse_btree_header(page, is_first_page=True)[0]
             # Print the number of tables in the database
@@ -41,11 +50,9 @@ def main():
             # Print the names of all tables in the database, excluding system tables
             print(
                 " ".join(
-                    row.tbl_name
-                    for row in select_all_from_sqlite_schema(
-                        database_file, db_config
-                    )
-                    if row.type == "table" and not row.tbl_name.startswith("sqlite_")
+                    tbl_name
+                    for type_, tbl_name in select_type_and_name_from_sqlite_schema(db)
+                    if type_ == "table" and not tbl_name.startswith("sqlite_")
                 )
             )
         else:
@@ -58,12 +65,8 @@ def main():
                 return 1
 
             table_name = stmt.from_table
-            if table_name.casefold() in (
-                "sqlite_schema".casefold(),
-                "sqlite_master".casefold(),
-                "sqlite_temp_schema".casefold(),
-                "sqlite_temp_master".casefold(),
-            ):
+            table_name_cf = table_name.casefold()
+            if table_name_cf in _SYSTEM_TABLES:
                 # Handle system tables
                 table_schema = SqliteSchema(
                     "table",
@@ -80,44 +83,14 @@ def main():
                 )
             else:
                 # Find the schema for the specified table
-                try:
-                    table_schema = next(
-                        table_info
-                        for table_info in select_all_from_sqlite_schema(
-                            database_file, db_config
-                        )
-                        if table_info.type == "table"
-                        and table_info.tbl_name.casefold() == table_name.casefold()
-                    )
-                except StopIteration:
+                table_schema = db.get_table_schema(table_name_cf)
+                if table_schema is None:
                     # Table not found
                     print(f"Unknown table '{table_name}'", file=sys.stderr)
                     return 1
 
-            # Get the page containing the table's root page
-            page = get_page(database_file, db_config, table_schema.rootpage)
-            btree_header, bytes_read = parse_btree_header(
-                page, table_schema.rootpage == 1
-            )
-
             # Parse the CREATE TABLE statement for the table
-            create_table_ast = next(parser.parse(table_schema.sql))
-            assert isinstance(create_table_ast, parser.CreateTableStmt)
-
-            # Create a mapping of column names to their order
-            column_order = {
-                name.casefold(): i for i, (name, _type) in enumerate(create_table_ast.columns)
-            }
-
-            # Find the index of the primary key column, if it exists
-            primary_key_column_idx = next(
-                (
-                    column_index
-                    for column_index, column in enumerate(create_table_ast.columns)
-                    if column.type.casefold().startswith("integer primary key".casefold())
-                ),
-                None,
-            )
+            columns, column_order, primary_key_column_idx = db.get_parsed_schema(table_schema)
 
             # Create a TableInfo namedtuple to store the table's root page and primary key column index
             table_info = TableInfo(rootpage=table_schema.rootpage, int_pk_column=primary_key_column_idx)
@@ -159,34 +132,51 @@ def main():
 
             where = None
             if stmt.where:
-                # Create a WHERE clause
-                where = (
-                    column_order[stmt.where.lhs.name.casefold()],
+                # Encode the WHERE clause into the raw forms its constant can be stored as
+                where_column = column_order[stmt.where.lhs.name.casefold()]
+                where = encode_where(
+                    db_config,
+                    table_info,
+                    where_column,
+                    columns[where_column].type,
                     stmt.where.rhs.text,
                 )
 
-            # Read the table and filter rows based on the selection and WHERE clause
-            rows = read_table(
-                database_file,
-                db_config,
-                table_info,
-                selected_columns,
-                where,
-            )
-
             if is_count_star:
-                # Count the number of rows
-                i = -1
-                for i, _ in enumerate(rows):
-                    pass
-                print(i + 1)
+                # Count the rows straight from the B-tree without decoding them
+                print(count_rows(db, table_info, where))
             else:
+                # Read the table and filter rows based on the selection and WHERE
+                # clause, one leaf page worth of rows at a time
+                batches = read_table_batches(db, table_info, selected_columns, where)
+
                 # Print the selected columns for each row
-                for column_values in rows:
-                    print("|".join(str(val) for val in column_values))
+                write_rows(batches)
 
     return 0
 
+def write_rows(batches):
+    # Write batches of rows to stdout as "|"-separated lines. Lines are collected
+    # and written to the binary buffer in large chunks rather than printed one by one.
+    out = sys.stdout.buffer
+    encoding, errors = sys.stdout.encoding, sys.stdout.errors
+    lines = []
+    format_row = None
+    for rows in batches:
+        if format_row is None and rows:
+            # Every row has the same width, so one "{}|{}|..." template formats
+            # a whole row in a single call instead of a str() per value and a join
+            format_row = "|".join(["{}"] * len(rows[0])).format
+        lines += [format_row(*column_values) for column_values in rows]
+        if len(lines) >= 4096:
+            lines.append("")
+            out.write("\n".join(lines).encode(encoding, errors))
+            lines.clear()
+    if lines:
+        lines.append("")
+        out.write("\n".join(lines).encode(encoding, errors))
+    out.flush()
+
 # Define a namedtuple for the B-tree header
 BTreeHeader = namedtuple(
     "BTreeHeader",
@@ -206,16 +196,20 @@ BTREE_PAGE_INTERIOR_TABLE = 0x05
 BTREE_PAGE_LEAF_INDEX = 0x0A
 BTREE_PAGE_LEAF_TABLE = 0x0D
 
+# Precompiled formats for the fixed-size fields read on every page
+_BTREE_HEADER = struct.Struct(">BHHHB")
+_UINT32 = struct.Struct(">I")
+
 def parse_btree_header(page, is_first_page=False):
     # Determine the offset for the B-tree header
     offset = 100 if is_first_page else 0
     # Unpack the B-tree header fields
     type_, first_freeblock, cell_count, cell_content_start, fragmented_free_bytes = (
-        struct.unpack_from(">BHHHB", page, offset)
+        _BTREE_HEADER.unpack_from(page, offset)
     )
     if type_ in (BTREE_PAGE_INTERIOR_INDEX, BTREE_PAGE_INTERIOR_TABLE):
         # Unpack the rightmost pointer for interior pages
-        (rightmost_pointer,) = struct.unpack_from(">I", page, offset + 8)
+        (rightmost_pointer,) = _UINT32.unpack_from(page, offset + 8)
         bytes_read = 12
     else:
         rightmost_pointer = 0
@@ -229,167 +223,751 @@ def parse_btree_header(page, is_first_page=False):
         rightmost_pointer,
     ), bytes_read
 
+# Compiled cell pointer array formats keyed by cell count, so a page's format
+# string isn't rebuilt and parsed again for every page with that many cells
+_CELL_POINTER_STRUCTS = {}
+
+def parse_cell_pointers(page, offset, cell_count):
+    # Decode a page's whole cell pointer array in one call
+    cell_pointers = _CELL_POINTER_STRUCTS.get(cell_count)
+    if cell_pointers is None:
+        cell_pointers = _CELL_POINTER_STRUCTS[cell_count] = struct.Struct(f">{cell_count}H")
+    return cell_pointers.unpack_from(page, offset)
+
 def parse_varint(buf, offset=0):
     # Parse a variable-length integer from the buffer
-    n = 0
-    for i in range(offset, offset + 9):
+    byte = buf[offset]
+    if byte < 0x80:
+        # Single-byte varints cover almost every serial type and small rowid
+        return byte, 1
+    n = byte & 0x7F
+    byte = buf[offset + 1]
+    if byte < 0x80:
+        return (n << 7) | byte, 2
+    n = (n << 7) | (byte & 0x7F)
+    for i in range(offset + 2, offset + 8):
         byte = buf[i]
-        n <<= 7
-        n |= byte & 0x7F
-        if byte & 0x80 == 0:
-            break
-    else:
-        i = -1
-    return n, i + 1 - offset
+        n = (n << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return n, i + 1 - offset
+    # The ninth byte contributes all 8 of its bits
+    return (n << 8) | buf[offset + 8], 9
+
+# Sizes of the fixed-width serial types 0 to 11. Types from 12 up are blobs and
+# text of size (serial_type - 12) >> 1. The reserved types 10 and 11 map to None.
+_SERIAL_TYPE_SIZES = (0, 1, 2, 3, 4, 6, 8, 8, 0, 0, None, None)
+
+def parse_record_header(page, offset, column_count):
+    # Parse only the serial types of the first column_count columns of a
+    # record, as used to pick the layout of a generated decoder
+    header_size, bytes_read = parse_varint(page, offset)
+    header_end = offset + header_size
+    offset += bytes_read
+    column_types = []
+    while offset != header_end and len(column_types) < column_count:
+        # Serial types almost always fit in one varint byte, so check for that
+        # before paying for a parse_varint call
+        column_serial_type = page[offset]
+        if column_serial_type < 0x80:
+            offset += 1
+        else:
+            column_serial_type, bytes_read = parse_varint(page, offset)
+            offset += bytes_read
+        column_types.append(column_serial_type)
+    return column_types
+
+def cell_matches(page, offset, where):
+    # Check a table leaf cell against an encoded WHERE clause
+    offset += parse_varint(page, offset)[1]  # payload size
+    rowid, bytes_read = parse_varint(page, offset)
+    return record_matches(page, offset + bytes_read, rowid, where)
+
+def record_matches(page, offset, rowid, where):
+    # Check the record at offset against an encoded WHERE clause by comparing
+    # the filter column's serial type and raw bytes, without decoding any value
+    if where.rowid is not None:
+        # The INTEGER PRIMARY KEY column is an alias for the rowid
+        return rowid == where.rowid
 
-def size_for_type(serial_type):
-    # Determine the size of a value based on its serial type
-    if serial_type < 5:
-        return serial_type
+    header_size, bytes_read = parse_varint(page, offset)
+    header_offset = offset + bytes_read
+    header_end = offset + header_size
+    # Walk the serial types up to the filter column, adding up the sizes of
+    # the columns before it, without building a list of column types
+    offset = header_end
+    for _column_id in range(where.column_id + 1):
+        if header_offset == header_end:
+            # Column missing from the record, so its value is NULL
+            return False
+        column_serial_type = page[header_offset]
+        if column_serial_type < 0x80:
+            header_offset += 1
+        else:
+            column_serial_type, bytes_read = parse_varint(page, header_offset)
+            header_offset += bytes_read
+        size = (
+            _SERIAL_TYPE_SIZES[column_serial_type]
+            if column_serial_type < 12
+            else (column_serial_type - 12) >> 1
+        )
+        offset += size
+    # Step back to the start of the filter column's value
+    offset -= size
+
+    raw_value = where.encodings.get(column_serial_type)
+    if raw_value is None:
+        # The value is stored as a type the constant cannot be equal to
+        return False
+    return page[offset : offset + len(raw_value)] == raw_value
+
+# Big-endian decoders for serial types 1 to 7: signed integers and a float. The
+# 24- and 48-bit widths have no struct code, so they are read as a signed high
+# part and an unsigned low part and combined.
+_INT8 = struct.Struct(">b")
+_INT16 = struct.Struct(">h")
+_INT24 = struct.Struct(">bH")
+_INT32 = struct.Struct(">i")
+_INT48 = struct.Struct(">hI")
+_INT64 = struct.Struct(">q")
+_FLOAT64 = struct.Struct(">d")
+
+# Serial types holding an integer, including the constants 0 and 1
+_INTEGER_SERIAL_TYPES = frozenset((1, 2, 3, 4, 5, 6, 8, 9))
+
+def decode_integer(page, offset, serial_type):
+    # Decode an integer column of one of _INTEGER_SERIAL_TYPES
+    if serial_type == 1:
+        return _INT8.unpack_from(page, offset)[0]
+    elif serial_type == 2:
+        return _INT16.unpack_from(page, offset)[0]
+    elif serial_type == 3:
+        high, low = _INT24.unpack_from(page, offset)
+        return (high << 16) | low
+    elif serial_type == 4:
+        return _INT32.unpack_from(page, offset)[0]
     elif serial_type == 5:
-        return 6
-    elif 6 <= serial_type <= 7:
-        return 8
-    elif 8 <= serial_type <= 9:
-        return 0
-    elif serial_type >= 12 and serial_type % 2 == 0:
-        return (serial_type - 12) // 2
-    elif serial_type >= 13 and serial_type % 2 == 1:
-        return (serial_type - 13) // 2
+        high, low = _INT48.unpack_from(page, offset)
+        return (high << 32) | low
+    elif serial_type == 6:
+        return _INT64.unpack_from(page, offset)[0]
     else:
-        raise NotImplementedError(serial_type)
-
-def parse_record(db_config, table_info, page, rowid, offset, selection, where):
-    # Parse a record from the page
-    initial_offset = offset
+        return serial_type - 8
+
+def parse_record(
+    decode_text, int_pk_column, page, rowid, offset, column_positions, column_count, column_values
+):
+    # Parse a record from the page into column_values, which must hold one
+    # None per selected column. column_positions gives each of the first
+    # column_count columns its index in column_values, or -1 when it isn't
+    # selected. The header and the column data are walked side by side, so no
+    # intermediate list of column types is built, and the walk stops after the
+    # last of the first column_count columns.
     header_size, bytes_read = parse_varint(page, offset)
+    header_offset = offset + bytes_read
     header_end = offset + header_size
-    offset += bytes_read
-    column_types = []
-    total_size = header_size
-    while offset != header_end:
-        column_serial_type, bytes_read = parse_varint(page, offset)
-        column_size = size_for_type(column_serial_type)
-        column_types.append((column_serial_type, column_size))
-        offset += bytes_read
-        total_size += column_size
-
-    column_selection = {column_id: order for order, column_id in enumerate(selection)}
-
-    column_values: list = [None] * len(column_selection)
-    for column_id, (column_serial_type, size) in enumerate(column_types):
-        if column_id not in column_selection and (not where or column_id != where[0]):
+    offset = header_end  # Column data starts right after the header
+
+    column_id = 0
+    while header_offset != header_end and column_id < column_count:
+        # Serial types almost always fit in one varint byte, so check for that
+        # before paying for a parse_varint call
+        column_serial_type = page[header_offset]
+        if column_serial_type < 0x80:
+            header_offset += 1
+        else:
+            column_serial_type, bytes_read = parse_varint(page, header_offset)
+            header_offset += bytes_read
+        size = (
+            _SERIAL_TYPE_SIZES[column_serial_type]
+            if column_serial_type < 12
+            else (column_serial_type - 12) >> 1
+        )
+
+        position = column_positions[column_id]
+        if position < 0:
             offset += size
+            column_id += 1
             continue
 
         if column_serial_type == 0:
-            if column_id == table_info.int_pk_column:
+            if column_id == int_pk_column:
                 value = rowid
             else:
                 value = None
-        elif 1 <= column_serial_type <= 6:
-            number_byte_size = (
-                column_serial_type
-                if column_serial_type < 5
-                else 6
-                if column_serial_type == 5
-                else 8
-            )
-            value = int.from_bytes(
-                page[offset : offset + number_byte_size], byteorder="big", signed=True
-            )
+        elif column_serial_type in _INTEGER_SERIAL_TYPES:
+            value = decode_integer(page, offset, column_serial_type)
         elif column_serial_type == 7:
-            value = struct.unpack_from(">d", page, offset)
-        elif column_serial_type in (8, 9):
-            value = int(column_serial_type == 9)
+            value = _FLOAT64.unpack_from(page, offset)
         elif column_serial_type >= 12 and column_serial_type % 2 == 0:
-            value_len = (column_serial_type - 12) // 2
-            value = page[offset : offset + value_len]
+            value = bytes(page[offset : offset + size])
         elif column_serial_type >= 13 and column_serial_type % 2 == 1:
-            value_len = (column_serial_type - 13) // 2
-            blob_value = page[offset : offset + value_len]
             try:
-                value = blob_value.decode(db_config.text_encoding)
+                value = decode_text(page[offset : offset + size], "strict", True)[0]
             except UnicodeDecodeError:
                 # FIXME: why does this happen?
-                value = blob_value
+                value = bytes(page[offset : offset + size])
         else:
             raise NotImplementedError(column_serial_type)
 
         offset += size
 
-        if where and column_id == where[0] and value != where[1]:
-            return None, total_size
+        column_values[position] = value
+        column_id += 1
+
+    return column_values
+
+def compile_record_decoder(
+    column_types, column_positions, int_pk_column, decode_text, batch_text=False
+):
+    # Generate a decoder specialized to the serial types of a sample record,
+    # with straight-line code for each column instead of parse_record's
+    # dispatch. Column types may change from one record to the next, so the
+    # decoder returns None as soon as a record doesn't fit the sample and the
+    # caller falls back to parse_record. Only used with non-empty column_types.
+    # With batch_text, text columns aren't decoded. Their raw slices are added
+    # to text_slices instead, to be decoded a page at a time by the caller;
+    # text_positions lists the row positions those slices belong to.
+    text_positions = []
+    # Putting batched values back into their rows costs about as much as
+    # decoding them one by one, so it only pays off with several text columns
+    selected_text_columns = sum(
+        1
+        for column_id, column_serial_type in enumerate(column_types)
+        if column_positions[column_id] >= 0
+        and column_serial_type >= 13
+        and column_serial_type % 2 == 1
+    )
+    batch_text = batch_text and selected_text_columns >= 2
+    lines = [
+        "def decode_record(page, offset, rowid, column_values, text_slices):",
+        "    header_size, bytes_read = parse_varint(page, offset)",
+        "    header_offset = offset + bytes_read",
+        "    header_end = offset + header_size",
+        "    offset = header_end",
+    ]
+    for column_id, column_serial_type in enumerate(column_types):
+        # Read the serial type, with the single-byte varint case inlined
+        lines += [
+            "    if header_offset == header_end:",
+            "        return None",
+            "    serial_type = page[header_offset]",
+            "    if serial_type < 0x80:",
+            "        header_offset += 1",
+            "    else:",
+            "        serial_type, bytes_read = parse_varint(page, header_offset)",
+            "        header_offset += bytes_read",
+        ]
 
-        if column_id in column_selection:
-            column_values[column_selection[column_id]] = value
+        if column_positions[column_id] < 0:
+            lines.append(
+                "    offset += SIZES[serial_type] if serial_type < 12 else (serial_type - 12) >> 1"
+            )
+            continue
 
-    return column_values, offset - initial_offset
+        target = f"column_values[{column_positions[column_id]}]"
+        if column_serial_type == 0:
+            # A NULL in the sample says nothing about the column's type, so
+            # every type gets a branch rather than later values bailing out
+            lines += [
+                "    if serial_type == 0:",
+                f"        {target} = rowid" if column_id == int_pk_column else "        pass",
+                "    elif serial_type in INTEGER_SERIAL_TYPES:",
+                f"        {target} = decode_integer(page, offset, serial_type)",
+                "        offset += SIZES[serial_type]",
+                "    elif serial_type >= 13 and serial_type & 1:",
+                "        size = (serial_type - 13) >> 1",
+                "        try:",
+                f"            {target} = decode_text(page[offset : offset + size], 'strict', True)[0]",
+                "        except UnicodeDecodeError:",
+                f"            {target} = bytes(page[offset : offset + size])",
+                "        offset += size",
+                "    elif serial_type >= 12:",
+                "        size = (serial_type - 12) >> 1",
+                f"        {target} = bytes(page[offset : offset + size])",
+                "        offset += size",
+                "    elif serial_type == 7:",
+                f"        {target} = _FLOAT64.unpack_from(page, offset)",
+                "        offset += 8",
+                "    else:",
+                "        return None",
+            ]
+        elif column_serial_type in _INTEGER_SERIAL_TYPES:
+            # Integer widths vary from record to record, so only the sample's
+            # width gets inline code and the others go through decode_integer
+            lines.append(f"    if serial_type == {column_serial_type}:")
+            if column_serial_type == 3:
+                lines.append("        high, low = _INT24.unpack_from(page, offset)")
+                lines.append(f"        {target} = (high << 16) | low")
+            elif column_serial_type == 5:
+                lines.append("        high, low = _INT48.unpack_from(page, offset)")
+                lines.append(f"        {target} = (high << 32) | low")
+            elif column_serial_type in (8, 9):
+                lines.append(f"        {target} = {column_serial_type - 8}")
+            else:
+                int_struct = {1: "_INT8", 2: "_INT16", 4: "_INT32", 6: "_INT64"}[column_serial_type]
+                lines.append(f"        ({target},) = {int_struct}.unpack_from(page, offset)")
+            lines += [
+                f"        offset += {_SERIAL_TYPE_SIZES[column_serial_type]}",
+                "    elif serial_type in INTEGER_SERIAL_TYPES:",
+                f"        {target} = decode_integer(page, offset, serial_type)",
+                "        offset += SIZES[serial_type]",
+                "    else:",
+                "        return None",
+            ]
+        elif column_serial_type == 7:
+            lines += [
+                "    if serial_type != 7:",
+                "        return None",
+                f"    {target} = _FLOAT64.unpack_from(page, offset)",
+                "    offset += 8",
+            ]
+        elif column_serial_type >= 12 and column_serial_type % 2 == 0:
+            lines += [
+                "    if serial_type < 12 or serial_type & 1:",
+                "        return None",
+                "    size = (serial_type - 12) >> 1",
+                f"    {target} = bytes(page[offset : offset + size])",
+                "    offset += size",
+            ]
+        elif column_serial_type >= 13 and column_serial_type % 2 == 1 and batch_text:
+            lines += [
+                "    if serial_type < 13 or not serial_type & 1:",
+                "        return None",
+                "    size = (serial_type - 13) >> 1",
+                f"    text{len(text_positions)} = page[offset : offset + size]",
+                "    offset += size",
+            ]
+            text_positions.append(column_positions[column_id])
+        elif column_serial_type >= 13 and column_serial_type % 2 == 1:
+            lines += [
+                "    if serial_type < 13 or not serial_type & 1:",
+                "        return None",
+                "    size = (serial_type - 13) >> 1",
+                "    try:",
+                f"        {target} = decode_text(page[offset : offset + size], 'strict', True)[0]",
+                "    except UnicodeDecodeError:",
+                f"        {target} = bytes(page[offset : offset + size])",
+                "    offset += size",
+            ]
+        else:
+            raise NotImplementedError(column_serial_type)
+    if len(column_types) < len(column_positions):
+        # The sample record stops before the last selected column, as rows
+        # written before an ALTER TABLE ... ADD COLUMN do. Records that store
+        # more columns than the sample go to parse_record instead of having
+        # the extra columns read as NULL.
+        lines += ["    if header_offset != header_end:", "        return None"]
+    if text_positions:
+        # Only hand the slices over once the whole record has matched
+        texts = ", ".join(f"text{i}" for i in range(len(text_positions)))
+        lines.append(f"    text_slices += ({texts},)")
+    lines.append("    return column_values")
+
+    namespace = {
+        "parse_varint": parse_varint,
+        "decode_text": decode_text,
+        "SIZES": _SERIAL_TYPE_SIZES,
+        "INTEGER_SERIAL_TYPES": _INTEGER_SERIAL_TYPES,
+        "decode_integer": decode_integer,
+        "_INT8": _INT8,
+        "_INT16": _INT16,
+        "_INT24": _INT24,
+        "_INT32": _INT32,
+        "_INT48": _INT48,
+        "_INT64": _INT64,
+        "_FLOAT64": _FLOAT64,
+    }
+    exec(compile("\n".join(lines), "<record decoder>", "exec"), namespace)
+    return namespace["decode_record"], tuple(text_positions)
+
+def decode_utf_8_batch(text_slices):
+    # Decode a batch of UTF-8 text slices with a single decode call, joining
+    # them with NUL and splitting the result back apart. Values that contain
+    # NUL or aren't valid UTF-8 send the batch down the one-by-one path.
+    try:
+        texts = b"\0".join(text_slices).decode("utf-8").split("\0")
+        if len(texts) == len(text_slices):
+            return texts
+    except UnicodeDecodeError:
+        pass
+
+    texts = []
+    for text_slice in text_slices:
+        try:
+            texts.append(codecs.utf_8_decode(text_slice, "strict", True)[0])
+        except UnicodeDecodeError:
+            # Same fallback as parse_record for text that isn't valid UTF-8
+            texts.append(bytes(text_slice))
+    return texts
+
+# Generated record decoders and their batched text positions, keyed by every
+# input compile_record_decoder shapes its code from: the sample's serial types,
+# the column positions, the INTEGER PRIMARY KEY column and the text encoding.
+# A sample shorter than the column positions gets a trailing end-of-header
+# check, and both lengths are part of the key, so a decoder generated from a
+# short record is never reused for a full one or the other way round.
+_DECODER_CACHE = {}
+
+# Buffer-level decoders for the text encodings a database can use
+_TEXT_DECODERS = {
+    "utf-8": codecs.utf_8_decode,
+    "utf-16-le": codecs.utf_16_le_decode,
+    "utf-16-be": codecs.utf_16_be_decode,
+}
 
 # Define namedtuples for database configuration and table information
 DBConfig = namedtuple("DBConfig", "page_size,text_encoding")
 TableInfo = namedtuple("TableInfo", "rootpage,int_pk_column")
 
-def get_page(file, db_config, id_):
-    # Get the page with the specified ID from the file
-    file.seek((id_ - 1) * db_config.page_size)
-    return file.read(db_config.page_size)
+class Database:
+    # Read-only database file mapped into memory, with a cache of recently used pages
+    def __init__(self, mm, db_config):
+        self.mm = mm
+        self.view = memoryview(mm)  # Zero-copy view of the whole file
+        self.config = db_config
+        # madvise is not available on every platform (e.g. Windows)
+        self.can_advise = hasattr(mmap, "MADV_WILLNEED")
+        if self.can_advise:
+            # Table scans mostly walk the file front to back
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        # Interior pages are revisited on every descent, so keep recent pages
+        # around instead of slicing them out of the mapping again. Entries are
+        # views into the mapping rather than copies, so an entry costs the same
+        # whatever the page size and the cache is sized by page count.
+        self.get_page = functools.lru_cache(maxsize=1024)(self._get_page)
+        self._table_schemas = None  # Built on the first table lookup
+        self._parsed_schemas = {}  # parse_table_schema results by root page
+
+    def _get_page(self, id_):
+        # Get a view of the page with the specified ID from the mapped file
+        page_size = self.config.page_size
+        return self.view[(id_ - 1) * page_size : id_ * page_size]
+
+    def get_table_schema(self, table_name_cf):
+        # Look up a table's sqlite_schema row by casefolded name, or None. The
+        # schema table is scanned once and indexed by name on first use.
+        if self._table_schemas is None:
+            self._table_schemas = {}
+            for row in select_all_from_sqlite_schema(self):
+                if row.type == "table":
+                    self._table_schemas.setdefault(row.tbl_name.casefold(), row)
+        return self._table_schemas.get(table_name_cf)
+
+    def get_parsed_schema(self, table_schema):
+        # Get parse_table_schema's result for a table of this database. It is
+        # kept on the database so it never outlives the file it came from.
+        if table_schema.rootpage not in self._parsed_schemas:
+            self._parsed_schemas[table_schema.rootpage] = parse_table_schema(table_schema)
+        return self._parsed_schemas[table_schema.rootpage]
+
+    def prefetch_pages(self, page_ids):
+        # Ask the kernel to start reading all the given pages in the background,
+        # issuing one madvise call per run of consecutive pages. The reads then
+        # overlap with parsing whichever page the caller is working on.
+        if not self.can_advise:
+            return
+        page_size = self.config.page_size
+        for first_id, run_length in _page_runs(page_ids):
+            start = (first_id - 1) * page_size
+            # madvise needs an offset aligned to the system page size
+            aligned_start = start - start % mmap.PAGESIZE
+            end = min(start + run_length * page_size, len(self.mm))
+            if end > aligned_start:
+                self.mm.madvise(mmap.MADV_WILLNEED, aligned_start, end - aligned_start)
+
+def _page_runs(page_ids):
+    # Split page IDs into (first_id, length) runs of consecutive IDs
+    first_id = prev_id = None
+    for id_ in page_ids:
+        if prev_id is not None and id_ == prev_id + 1:
+            prev_id = id_
+            continue
+        if first_id is not None:
+            yield first_id, prev_id - first_id + 1
+        first_id = prev_id = id_
+    if first_id is not None:
+        yield first_id, prev_id - first_id + 1
+
+# An equality WHERE clause encoded the way its constant is stored in a record:
+# a mapping of the serial types the constant can be stored as to their raw
+# bytes, or the rowid to look for when the column aliases the rowid
+EncodedWhere = namedtuple("EncodedWhere", "column_id,encodings,rowid")
+
+# Text SQLite converts to a number under INTEGER, REAL or NUMERIC affinity,
+# surrounding whitespace included
+_INTEGER_LITERAL = re.compile(r"[ \t\n\v\f\r]*[+-]?[0-9]+[ \t\n\v\f\r]*")
+_REAL_LITERAL = re.compile(
+    r"[ \t\n\v\f\r]*[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?[ \t\n\v\f\r]*"
+)
+
+def column_affinity(column_type):
+    # Get the type affinity of a column from its declared type, following the
+    # order of SQLite's rules
+    column_type = column_type.upper()
+    if "INT" in column_type:
+        return "INTEGER"
+    if "CHAR" in column_type or "CLOB" in column_type or "TEXT" in column_type:
+        return "TEXT"
+    if "BLOB" in column_type or not column_type:
+        return "BLOB"
+    if "REAL" in column_type or "FLOA" in column_type or "DOUB" in column_type:
+        return "REAL"
+    return "NUMERIC"
+
+def encode_where(db_config, table_info, column_id, column_type, text):
+    # Encode the WHERE constant once, following the column's type affinity, so
+    # cells can be filtered by comparing raw bytes
+    affinity = column_affinity(column_type)
+    if affinity in ("INTEGER", "REAL", "NUMERIC") and _REAL_LITERAL.fullmatch(text):
+        # Columns with a numeric affinity store number-looking text as numbers,
+        # and REAL columns store whole values as integers, so the constant is
+        # looked for in both forms. Integer text too big for 64 bits becomes a
+        # float, as it does in SQLite.
+        value = int(text) if _INTEGER_LITERAL.fullmatch(text) else float(text)
+        if not -(1 << 63) <= value < 1 << 63:
+            value = float(value)
+        integer_value = None
+        if isinstance(value, int):
+            integer_value = value
+        elif value.is_integer() and -(1 << 63) <= value < 1 << 63:
+            integer_value = int(value)
+
+        if column_id == table_info.int_pk_column:
+            # A constant that isn't a whole number matches no rowid, and the
+            # column itself is always stored as NULL
+            return EncodedWhere(column_id, {}, integer_value)
+
+        encodings = {}
+        if integer_value is not None:
+            encodings.update(_integer_encodings(integer_value))
+        if float(value) == value:
+            # Adding 0.0 turns -0.0 into 0.0, the form zero is stored in
+            encodings[7] = _FLOAT64.pack(float(value) + 0.0)
+        return EncodedWhere(column_id, encodings, None)
+    raw_value = text.encode(db_config.text_encoding)
+    return EncodedWhere(column_id, {len(raw_value) * 2 + 13: raw_value}, None)
+
+def _integer_encodings(value):
+    # Get the serial types and big-endian bytes an integer can be stored as
+    encodings = {}
+    if value in (0, 1):
+        # Schema format 4 stores 0 and 1 as serial types 8 and 9 with no body
+        encodings[8 + value] = b""
+    # Integers are stored in the narrowest width that holds them
+    for serial_type, width in ((1, 1), (2, 2), (3, 3), (4, 4), (5, 6), (6, 8)):
+        if -(1 << (width * 8 - 1)) <= value < 1 << (width * 8 - 1):
+            encodings[serial_type] = value.to_bytes(width, byteorder="big", signed=True)
+            break
+    return encodings
 
-def read_table(file, db_config, table_info, selection, where):
-    # Read the table and yield rows based on the selection and WHERE clause
-    page = get_page(file, db_config, table_info.rootpage)
-    yield from _read_table(file, db_config, table_info, page, selection, where)
+def count_rows(db, table_info, where):
+    # Count the rows of a table by summing the cell counts of its leaf pages,
+    # so records are only looked at when a WHERE clause has to be checked
+    return _count_rows(db, table_info.rootpage, where)
 
-def _read_table(file, db_config, table_info, page, selection, where):
-    # Recursively read the table and yield rows based on the selection and WHERE clause
-    btree_header, bytes_read = parse_btree_header(page, is_first_page=table_info.rootpage == 1)
+def _count_rows(db, page_id, where):
+    # Recursively count the rows in the subtree rooted at the given page
+    page = db.get_page(page_id)
+    btree_header, bytes_read = parse_btree_header(page, is_first_page=page_id == 1)
+    if btree_header.type == BTREE_PAGE_LEAF_TABLE and not where:
+        return btree_header.cell_count
 
     btree_offset = bytes_read
-    if table_info.rootpage == 1:
+    if page_id == 1:
         btree_offset += 100
-
-    for _i in range(btree_header.cell_count):
-        (cell_content_offset,) = struct.unpack_from(">H", page, btree_offset)
-        btree_offset += 2
+    cell_offsets = parse_cell_pointers(page, btree_offset, btree_header.cell_count)
+
+    if btree_header.type == BTREE_PAGE_LEAF_TABLE:
+        return sum(1 for cell_offset in cell_offsets if cell_matches(page, cell_offset, where))
+
+    assert btree_header.type == BTREE_PAGE_INTERIOR_TABLE
+    child_ids = [_UINT32.unpack_from(page, cell_offset)[0] for cell_offset in cell_offsets]
+    child_ids.append(btree_header.rightmost_pointer)
+    db.prefetch_pages(child_ids)
+    return sum(_count_rows(db, child_id, where) for child_id in child_ids)
+
+def read_table_batches(db, table_info, selection, where):
+    # Read the table and yield a list of the matching rows of each leaf page.
+    # Rows are collected in a tight loop, so the generator is resumed once per
+    # page instead of once per row.
+    int_pk_column = table_info.int_pk_column
+    # Columns past the last selected one are never looked at
+    column_count = max(selection, default=-1) + 1
+    # Map each column up to the last selected one to its position in the
+    # output, or -1 when it isn't selected, so the per-column check in
+    # parse_record is a list index rather than a dict lookup
+    column_positions = [-1] * column_count
+    # A column selected more than once is decoded into its first position and
+    # copied to the others once the page's rows are filled in
+    duplicate_positions = []
+    for order, column_id in enumerate(selection):
+        if column_positions[column_id] < 0:
+            column_positions[column_id] = order
+        else:
+            duplicate_positions.append((column_positions[column_id], order))
+    # The INTEGER PRIMARY KEY column is stored as NULL and read from the rowid,
+    # so when it is the only column selected no record needs to be read at all
+    rowid_only = column_count > 0 and all(
+        column_id == int_pk_column for column_id in selection
+    )
+    # The codecs decoders accept the page memoryview directly, so text is
+    # decoded without first copying it into a bytes object
+    decode_text = _TEXT_DECODERS[db.config.text_encoding]
+    empty_row = (None,) * len(selection)
+    # Specialized decoder, generated from the first record that gets decoded
+    decode_record = None
+    # UTF-8 text is cheaper to decode a page at a time than value by value
+    batch_text = db.config.text_encoding == "utf-8"
+
+    # Walk the B-tree with an explicit stack of page IDs rather than recursing,
+    # so every row is yielded straight from this generator
+    stack = [table_info.rootpage]
+    while stack:
+        page_id = stack.pop()
+        page = db.get_page(page_id)
+        btree_header, bytes_read = parse_btree_header(page, is_first_page=page_id == 1)
+
+        btree_offset = bytes_read
+        if page_id == 1:
+            btree_offset += 100
+
+        cell_offsets = parse_cell_pointers(page, btree_offset, btree_header.cell_count)
 
         if btree_header.type == BTREE_PAGE_INTERIOR_TABLE:
-            (left_ptr,) = struct.unpack_from(">I", page, cell_content_offset)
-            left_page = get_page(file, db_config, left_ptr)
-            yield from _read_table(file, db_config, table_info, left_page, selection, where)
-        else:
-            assert btree_header.type == BTREE_PAGE_LEAF_TABLE
-            payload_size, bytes_read = parse_varint(page, cell_content_offset)
-            cell_content_offset += bytes_read
+            child_ids = [
+                _UINT32.unpack_from(page, cell_offset)[0] for cell_offset in cell_offsets
+            ]
+            child_ids.append(btree_header.rightmost_pointer)
+            # Start reading every child page before descending into the first one
+            db.prefetch_pages(child_ids)
+            # Push the children in reverse so the leftmost one is visited first
+            child_ids.reverse()
+            stack.extend(child_ids)
+            continue
+
+        assert btree_header.type == BTREE_PAGE_LEAF_TABLE
+        rows = []
+        # Raw text of the rows the specialized decoder handled, plus the index
+        # of every row that went through parse_record instead
+        text_slices = []
+        fallback_rows = []
+        for cell_content_offset in cell_offsets:
+            # Skip the payload size, the record is only parsed as far as needed
+            cell_content_offset += parse_varint(page, cell_content_offset)[1]
 
             rowid, bytes_read = parse_varint(page, cell_content_offset)
             cell_content_offset += bytes_read
 
-            column_values, bytes_read = parse_record(
-                db_config, table_info, page, rowid, cell_content_offset, selection, where
-            )
-            assert bytes_read == payload_size, (bytes_read, payload_size)
+            # Check the filter column on its raw bytes before decoding any
+            # selected column, so rejected rows never allocate values
+            if where and not record_matches(page, cell_content_offset, rowid, where):
+                continue
+
+            if rowid_only:
+                rows.append([rowid] * len(selection))
+                continue
 
-            # filtered out
-            if column_values is None:
+            row = list(empty_row)
+
+            if decode_record is None and column_count:
+                column_types = parse_record_header(page, cell_content_offset, column_count)
+                decoder_key = (
+                    tuple(column_types),
+                    tuple(column_positions),
+                    int_pk_column,
+                    db.config.text_encoding,
+                )
+                if decoder_key not in _DECODER_CACHE:
+                    _DECODER_CACHE[decoder_key] = compile_record_decoder(
+                        column_types, column_positions, int_pk_column, decode_text, batch_text
+                    )
+                decode_record, text_positions = _DECODER_CACHE[decoder_key]
+            if decode_record is not None and decode_record(
+                page, cell_content_offset, rowid, row, text_slices
+            ) is not None:
+                rows.append(row)
                 continue
 
-            yield column_values
+            # The record doesn't match the specialized layout
+            fallback_rows.append(len(rows))
+            row[:] = empty_row
+            rows.append(
+                parse_record(
+                    decode_text,
+                    int_pk_column,
+                    page,
+                    rowid,
+                    cell_content_offset,
+                    column_positions,
+                    column_count,
+                    row,
+                )
+            )
 
-    if btree_header.type == BTREE_PAGE_INTERIOR_TABLE:
-        rightmost_page = get_page(file, db_config, btree_header.rightmost_pointer)
-        yield from _read_table(file, db_config, table_info, rightmost_page, selection, where)
+        if text_slices:
+            # Decode the page's text in one go and put each value in its row
+            texts = decode_utf_8_batch(text_slices)
+            decoded_rows = rows
+            if fallback_rows:
+                skipped = set(fallback_rows)
+                decoded_rows = [row for i, row in enumerate(rows) if i not in skipped]
+            for i, position in enumerate(text_positions):
+                for row, text in zip(decoded_rows, texts[i :: len(text_positions)]):
+                    row[position] = text
+        if duplicate_positions:
+            for row in rows:
+                for source, target in duplicate_positions:
+                    row[target] = row[source]
+        yield rows
 
 # Define a namedtuple for the SQLite schema
 SqliteSchema = namedtuple(
     "SqliteSchema", ["type", "name", "tbl_name", "rootpage", "sql"]
 )
 
-def select_all_from_sqlite_schema(file, db_config):
+# Casefolded type prefix marking a column as an alias for the rowid
+_INTEGER_PRIMARY_KEY_CF = "integer primary key".casefold()
+
+def parse_table_schema(table_schema):
+    # Parse a table's CREATE TABLE statement into its columns, a mapping of
+    # column names to their order and the index of the INTEGER PRIMARY KEY
+    # column (or None)
+    create_table_ast = next(parser.parse(table_schema.sql))
+    assert isinstance(create_table_ast, parser.CreateTableStmt)
+
+    # Create a mapping of column names to their order
+    column_order = {
+        name.casefold(): i for i, (name, _type) in enumerate(create_table_ast.columns)
+    }
+
+    # Find the index of the primary key column, if it exists
+    primary_key_column_idx = next(
+        (
+            column_index
+            for column_index, column in enumerate(create_table_ast.columns)
+            if column.type.casefold().startswith(_INTEGER_PRIMARY_KEY_CF)
+        ),
+        None,
+    )
+
+    return create_table_ast.columns, column_order, primary_key_column_idx
+
+def select_all_from_sqlite_schema(db):
     # Select all rows from the SQLite schema table
-    for column_values in read_table(
-        file, db_config, TableInfo(1, None), list(range(5)), None
-    ):
-        yield SqliteSchema(*column_values)
+    return [
+        SqliteSchema(*column_values)
+        for rows in read_table_batches(db, TableInfo(1, None), list(range(5)), None)
+        for column_values in rows
+    ]
+
+def select_type_and_name_from_sqlite_schema(db):
+    # Select only the type and tbl_name columns from the SQLite schema table,
+    # so the rootpage and sql columns are never decoded
+    return [
+        (type_, tbl_name)
+        for rows in read_table_batches(db, TableInfo(1, None), [0, 2], None)
+        for type_, tbl_name in rows
+    ]
 
 if __name__ == "__main__":
     # Run the main function when the script is executed
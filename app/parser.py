@@ -1,7 +1,8 @@
+import re
+import sys
 from collections import namedtuple
 
-# Define a namedtuple for tokens with type and text attributes
-Token = namedtuple("Token", "type,text")
+# Tokens are plain (type, text) tuples, read by index in the parser
 _NOTHING = object()  # Sentinel object to represent no value
 
 # Custom exception for parse errors
@@ -32,65 +33,75 @@ class _peekable:
                 self._peeked = None
         return self._peeked
 
-# Function to scan the input text and generate tokens
-def scan(text):
-    yield from _scan(_peekable(iter(text)))
+# Token types, interned so the parser can compare them by identity
+_COMMA = sys.intern("COMMA")
+_LPAREN = sys.intern("LPAREN")
+_RPAREN = sys.intern("RPAREN")
+_SEMICOLON = sys.intern("SEMICOLON")
+_STAR = sys.intern("STAR")
+_EQUAL = sys.intern("EQUAL")
+_SELECT = sys.intern("SELECT")
+_FROM = sys.intern("FROM")
+_WHERE = sys.intern("WHERE")
+_CREATE = sys.intern("CREATE")
+_TABLE = sys.intern("TABLE")
+_NAME = sys.intern("NAME")
+_STRING = sys.intern("STRING")
 
 # Mapping of single-character tokens to their types
 _one_char_tokens = {
-    ",": "COMMA",
-    "(": "LPAREN",
-    ")": "RPAREN",
-    ";": "SEMICOLON",
-    "*": "STAR",
-    "=": "EQUAL",
+    ",": _COMMA,
+    "(": _LPAREN,
+    ")": _RPAREN,
+    ";": _SEMICOLON,
+    "*": _STAR,
+    "=": _EQUAL,
 }
 
 # Mapping of keywords to their types
 _keywords = {
-    "SELECT".casefold(): "SELECT",
-    "FROM".casefold(): "FROM",
-    "WHERE".casefold(): "WHERE",
-    "CREATE".casefold(): "CREATE",
-    "TABLE".casefold(): "TABLE",
+    "SELECT".casefold(): _SELECT,
+    "FROM".casefold(): _FROM,
+    "WHERE".casefold(): _WHERE,
+    "CREATE".casefold(): _CREATE,
+    "TABLE".casefold(): _TABLE,
+}
+
+# Patterns used to consume whole tokens at once
+_whitespace_re = re.compile(r"\s+")
+_name_re = re.compile(r"[^\W\d_]\w*")  # A letter followed by letters, digits or "_"
+_string_res = {
+    # Quotes inside a literal are escaped by doubling them
+    "'": re.compile(r"'([^']*(?:''[^']*)*)'"),
+    '"': re.compile(r'"([^"]*(?:""[^"]*)*)"'),
 }
 
-# Internal function to scan the input and generate tokens
-def _scan(it):
-    while True:
-        c = next(it, None)  # Get the next character
-        if c is None:
-            break  # End of input
+# Function to scan the input text and generate tokens
+def scan(text):
+    # Walk an index over the text, matching each identifier, string literal or
+    # run of whitespace with a single regex call
+    i = 0
+    while i < len(text):
+        c = text[i]
 
         if c.isspace():
-            continue  # Skip whitespace
+            i = _whitespace_re.match(text, i).end()  # Skip whitespace
         elif c in _one_char_tokens:
-            yield Token(_one_char_tokens[c], c)  # Single-character token
+            yield (_one_char_tokens[c], c)  # Single-character token
+            i += 1
         elif c.isalpha():
             # Handle identifiers and keywords
-            name = c
-            while it.peek() is not None and (it.peek().isalnum() or it.peek() == "_"):
-                name += next(it)
-            if name.casefold() in _keywords:
-                yield Token(_keywords[name.casefold()], name)
-            else:
-                yield Token("NAME", name)
-        elif c in ("'", '"'):
+            match = _name_re.match(text, i)
+            name = match.group()
+            i = match.end()
+            yield (_keywords.get(name.casefold(), _NAME), name)
+        elif c in _string_res:
             # Handle string literals
-            terminator = c
-            str_content = ""
-            while True:
-                c = next(it, None)
-                if c is None:
-                    raise ParseError("Unterminated string literal")
-                if c == terminator:
-                    if it.peek() == terminator:
-                        str_content += terminator
-                    else:
-                        break
-                else:
-                    str_content += c
-            yield Token("STRING", str_content)
+            match = _string_res[c].match(text, i)
+            if match is None:
+                raise ParseError("Unterminated string literal")
+            yield (_STRING, match.group(1).replace(c * 2, c))
+            i = match.end()
         else:
             raise ParseError(f"Unexpected token {c!r}")
 
@@ -100,8 +111,8 @@ def _expect(it, ty):
         tok = next(it)
     except StopIteration:
         raise ParseError(f"Expected {ty}, got end of input")
-    if tok.type != ty:
-        raise ParseError(f"Expected {ty}, got {tok.type}")
+    if tok[0] is not ty:
+        raise ParseError(f"Expected {ty}, got {tok[0]}")
     return tok
 
 # Function to parse the input text and generate parse trees
@@ -120,9 +131,9 @@ StringExpr = namedtuple("StringExpr", "text")
 
 # Internal function to parse the input and generate parse trees
 def _parse(it):
-    if it.peek() and it.peek().type == "SELECT":
+    if it.peek() and it.peek()[0] is _SELECT:
         yield _parse_select_stmt(it)
-    elif it.peek() and it.peek().type == "CREATE":
+    elif it.peek() and it.peek()[0] is _CREATE:
         yield _parse_create_table(it)
     else:
         raise ParseError(f"Unexpected token {it.peek()!r}")
@@ -132,24 +143,24 @@ def _parse(it):
 
 # Function to parse a SELECT statement
 def _parse_select_stmt(it):
-    _expect(it, "SELECT")
+    _expect(it, _SELECT)
 
     selects = []
     first = True
-    while it.peek() and it.peek().type != "FROM":
+    while it.peek() and it.peek()[0] is not _FROM:
         if first:
             first = False
         else:
-            _expect(it, "COMMA")
+            _expect(it, _COMMA)
         selects.append(_parse_selection(it))
 
-    _expect(it, "FROM")
+    _expect(it, _FROM)
 
-    from_table = _expect(it, "NAME")
+    from_table = _expect(it, _NAME)
 
     tok = next(it, None)
     where = None
-    if tok and tok.type == "WHERE":
+    if tok and tok[0] is _WHERE:
         # FIXME: proper expression parsing
         lhs = next(it, None)
         op = next(it, None)
@@ -158,75 +169,77 @@ def _parse_select_stmt(it):
             lhs is None
             or op is None
             or rhs is None
-            or lhs.type != "NAME"
-            or op.type != "EQUAL"
-            or rhs.type != "STRING"
+            or lhs[0] is not _NAME
+            or op[0] is not _EQUAL
+            or rhs[0] is not _STRING
         ):
             raise ParseError("Unsupported WHERE clause")
-        where = BinaryExpr(op.type, NameExpr(lhs.text), StringExpr(rhs.text))
-    elif tok and tok.type != "SEMICOLON":
-        raise ParseError(f"Expected end of input or semicolon, got {tok.text!r}")
+        where = BinaryExpr(op[0], NameExpr(lhs[1]), StringExpr(rhs[1]))
+    elif tok and tok[0] is not _SEMICOLON:
+        raise ParseError(f"Expected end of input or semicolon, got {tok[1]!r}")
 
-    return SelectStmt(selects, from_table.text, where)
+    return SelectStmt(selects, from_table[1], where)
 
 # Function to parse a selection in a SELECT statement
 def _parse_selection(it):
     name = next(it, None)
-    if not name or name.type not in ("NAME", "STAR"):
+    if not name or name[0] not in (_NAME, _STAR):
         raise ParseError(f"Expected name or '*', got {name!r}")
 
-    if name.type == "STAR":
+    if name[0] is _STAR:
         return StarExpr()
 
-    if not it.peek() or it.peek().type != "LPAREN":
-        return NameExpr(name.text)
+    if not it.peek() or it.peek()[0] is not _LPAREN:
+        return NameExpr(name[1])
 
     args = []
     first = True
     next(it)
-    while it.peek() and it.peek().type != "RPAREN":
+    while it.peek() and it.peek()[0] is not _RPAREN:
         if first:
             first = False
         else:
-            _expect(it, "COMMA")
+            _expect(it, _COMMA)
         args.append(_parse_selection(it))
 
-    _expect(it, "RPAREN")
+    _expect(it, _RPAREN)
 
-    return FunctionExpr(name.text.upper(), args)
+    return FunctionExpr(name[1].upper(), args)
 
 # Function to parse a CREATE TABLE statement
 def _parse_create_table(it):
-    _expect(it, "CREATE")
-    _expect(it, "TABLE")
+    _expect(it, _CREATE)
+    _expect(it, _TABLE)
 
     name = next(it, None)
     if name is None:
         raise ParseError("Unexpected end of input, expected table name")
-    elif name.type not in ("NAME", "STRING"):
-        raise ParseError(f"Expected table name to be string or name, got {name.text!r}")
+    elif name[0] not in (_NAME, _STRING):
+        raise ParseError(f"Expected table name to be string or name, got {name[1]!r}")
 
-    table_name = name.text
+    table_name = name[1]
 
-    _expect(it, "LPAREN")
+    _expect(it, _LPAREN)
     columns = []
     first = True
-    while it.peek() and it.peek().type != "RPAREN":
+    while it.peek() and it.peek()[0] is not _RPAREN:
         if first:
             first = False
         else:
-            _expect(it, "COMMA")
-        col_name = _expect(it, "NAME").text
+            _expect(it, _COMMA)
+        col_name = _expect(it, _NAME)[1]
+        # The type is the run of names up to the next comma or closing
+        # parenthesis; anything else is caught by the COMMA/RPAREN checks
         type_parts = []
-        while it.peek() and it.peek().type not in ("COMMA", "RPAREN"):
-            type_parts.append(_expect(it, "NAME").text)
+        while it.peek() and it.peek()[0] is _NAME:
+            type_parts.append(next(it)[1])
         col_type = " ".join(type_parts)
         columns.append(CreateTableField(col_name, col_type))
 
-    _expect(it, "RPAREN")
+    _expect(it, _RPAREN)
 
     tok = next(it, None)
-    if tok and tok.type != "SEMICOLON":
-        raise ParseError(f"Expected end of input or semicolon, got {tok.text!r}")
+    if tok and tok[0] is not _SEMICOLON:
+        raise ParseError(f"Expected end of input or semicolon, got {tok[1]!r}")
 
     return CreateTableStmt(table_name, tuple(columns))
\ No newline at end of file